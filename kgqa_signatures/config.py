@@ -1,6 +1,23 @@
 MEDIAWIKI_API_URL = "https://www.wikidata.org/w/api.php"
 # SPARQL_API_URL = "https://query.wikidata.org/sparql"
 SPARQL_API_URL = "http://127.0.0.1:7001"
+# local replicas, requests are routed to the one with least outstanding requests
+SPARQL_API_URLS = [SPARQL_API_URL]
+SPARQL_API_MAX_FAILURES = 3
+SPARQL_API_EJECT_SECONDS = 30
 CACHE_DIRECTORY = "wikidata/cache"
+# version of data loaded into SPARQL endpoint (e.g. dump date '20231001'), stored with every cache entry
+# so that entries of older dumps can be evicted
+ENDPOINT_DATA_VERSION = None
 LOG_FILENAME = "log.json"
 DISABLE_PARALLEL = False
+# drop the '?object wdt:P31 ?smth' join from neighbour queries and filter objects on the client side
+# against a bitset of typed entities (built from a dump or gathered lazily from the endpoint)
+ENTITY_FILTER_ENABLED = False
+ENTITY_FILTER_DIRECTORY = "wikidata/entity_filter"
+# choose order and direction of the question entity neighbour lookup by cached degree statistics
+# (ties in signature score are then resolved by the smallest QID, not by the order of endpoint rows)
+QUERY_PLANNER_ENABLED = False
+QUERY_PLANNER_DEGREE_CAP = 10000
+# per question results are streamed to this Parquet file when set (requires pyarrow)
+RESULTS_EXPORT_FILEPATH = None
@@ -6,6 +6,9 @@ import sys
 
 from kgqa_signatures.config import LOG_FILENAME
 
+# fields added to every JSON log record of this process (e.g. index of processed question)
+_log_context = {}
+
 
 class JSONFormatter(logging.Formatter):
     """JSONFormatter - formatter for python logging"""
@@ -26,6 +29,10 @@ class JSONFormatter(logging.Formatter):
         if "process_id" not in record.msg:
             record.msg["process_id"] = os.getpid()
 
+        for key, value in _log_context.items():
+            if key not in record.msg:
+                record.msg[key] = value
+
         record.msg = json.dumps(record.msg)
         return super().format(record)
 
@@ -49,4 +56,12 @@ def get_logger():
     return main_logger
 
 
+def get_log_context():
+    return dict(_log_context)
+
+
+def set_log_context(**kwargs):
+    _log_context.update(kwargs)
+
+
 default_logger = get_logger()
@@ -1,8 +1,9 @@
 import dataclasses
+import json
 import time
+import uuid
 
-from sklearn.metrics import precision_score
-
+from kgqa_signatures.config import RESULTS_EXPORT_FILEPATH
 from kgqa_signatures.dataset import (
     DatasetRecord,
     apple_ml_mkqa,
@@ -10,11 +11,16 @@ from kgqa_signatures.dataset import (
     mintaka,
     wikidata_simplequestions
 )
+from kgqa_signatures.logger import set_log_context
+from kgqa_signatures.metrics import StreamingMetrics
+from kgqa_signatures.results_export import ParquetResultsSink, score_summary, signature_top
 from kgqa_signatures.signature import (
     build_entity_signature,
-    find_neighbour_by_signature,
-    gather_answers_connections
+    gather_answers_connections,
+    rank_neighbours_by_signature,
+    select_answer_entity
 )
+from kgqa_signatures.wikidata.api import get_request_counters
 from kgqa_signatures.wikidata.service import get_entity_one_hop_neighbours
 from kgqa_signatures.wikidata.sparql_condition import SparqlCondition
 
@@ -43,16 +49,20 @@ def entity_linker_question(sentence_with_entity: str):
     return "Q30"
 
 
-def process_dataset(dataset_records_provider):
-    gt_answers_entities = []
-    estimated_answers_entities = []
+def process_dataset(dataset_records_provider, results_sink=None) -> StreamingMetrics:
+    metrics = StreamingMetrics()
+    # log file is appended by every run, so question indexes are unique only within a run
+    set_log_context(run_id=uuid.uuid4().hex)
 
     for index, record in enumerate(dataset_records_provider):
         start_time = time.time()
+        # log records of the question, also from joblib workers, are marked to replay them per question
+        set_log_context(question_index=index)
         # Step 0: some datasets don't provide entity for question, so we detect it ourselves
         if record.question_entity is None:
             question_entity = entity_linker_question(record.question)
             record = dataclasses.replace(record, question_entity=question_entity)
+        linking_time = time.time()
 
         # Step 1: infer LLM to produce answer variants
         if record.llm_predicted_answers is None or record.llm_predicted_answers_entities is None:
@@ -63,33 +73,74 @@ def process_dataset(dataset_records_provider):
                 llm_predicted_answers=answers,
                 llm_predicted_answers_entities=answers_entities
             )
+        llm_time = time.time()
 
         # Step 2: gather neighbours and connections of entities from all answers to common table
         # TODO: SPARSQL returns the last object connected with from list (for example city with many head of governments)
-        gathered_connections = gather_answers_connections(record.llm_predicted_answers_entities, n_jobs=6)
+        gather_request_counters = {"requests": 0, "endpoint_requests": 0}
+        gathered_connections = gather_answers_connections(
+            record.llm_predicted_answers_entities,
+            n_jobs=6,
+            request_counters=gather_request_counters
+        )
+        gather_time = time.time()
 
         # Step 3: build signature of good entity
         signature_table = build_entity_signature(gathered_connections)
+        signature_time = time.time()
 
         # Step 4: get best neighbour by signature
-        answer_entity = find_neighbour_by_signature(
+        ranking_request_counters = get_request_counters()
+        neighbours_score = rank_neighbours_by_signature(
             signature_table,
             record.question_entity,
             record.llm_predicted_answers_entities,
             top_n_signatures=5,
             take_all_signature_rules_with_full_match=True
         )
+        answer_entity = select_answer_entity(neighbours_score)
+        ranking_request_counters = {
+            key: value - ranking_request_counters[key] for key, value in get_request_counters().items()
+        }
 
         # Step 5: check answer
-        gt_answers_entities.append(record.answer_entity)
-        estimated_answers_entities.append(answer_entity)
         is_correct = answer_entity == record.answer_entity
         end_time = time.time()
+        if record.question_to_answer_connection is not None:
+            relation = record.question_to_answer_connection
+        elif record.answer_to_question_connection is not None:
+            relation = f"R{record.answer_to_question_connection[1:]}"
+        else:
+            relation = None
+        metrics.update(record.answer_entity, answer_entity, relation, (end_time - start_time) * 1000)
         print(f"Question: {record.question} Answer_entity: {answer_entity}"
               f" Is correct: {is_correct} Correct answer_entity: {record.answer_entity}")
         print(f"Iteration time: {int((end_time - start_time) * 1000)} ms")
 
-    return precision_score(gt_answers_entities, estimated_answers_entities, average='micro')
+        if results_sink is not None:
+            results_sink.write({
+                "question": record.question,
+                "question_entity": record.question_entity,
+                "relation": relation,
+                "gold_entity": record.answer_entity,
+                "predicted_entity": answer_entity,
+                "is_correct": is_correct,
+                "answers_entities": record.llm_predicted_answers_entities,
+                "signature_top": signature_top(signature_table),
+                **score_summary(neighbours_score),
+                "time_linking_ms": (linking_time - start_time) * 1000,
+                "time_llm_ms": (llm_time - linking_time) * 1000,
+                "time_gather_ms": (gather_time - llm_time) * 1000,
+                "time_signature_ms": (signature_time - gather_time) * 1000,
+                "time_ranking_ms": (end_time - signature_time) * 1000,
+                "time_total_ms": (end_time - start_time) * 1000,
+                "requests_gather": gather_request_counters["requests"],
+                "endpoint_requests_gather": gather_request_counters["endpoint_requests"],
+                "requests_ranking": ranking_request_counters["requests"],
+                "endpoint_requests_ranking": ranking_request_counters["endpoint_requests"],
+            })
+
+    return metrics
 
 
 if __name__ == "__main__":
@@ -101,7 +152,13 @@ if __name__ == "__main__":
     # dataset_records_provider = mintaka("data/mintaka/mintaka_test.json")
     start_time = time.time()
     dataset_records_provider = debug_data()
-    precision = process_dataset(dataset_records_provider)
+    if RESULTS_EXPORT_FILEPATH is not None:
+        with ParquetResultsSink(RESULTS_EXPORT_FILEPATH) as results_sink:
+            metrics = process_dataset(dataset_records_provider, results_sink).to_dict()
+    else:
+        metrics = process_dataset(dataset_records_provider).to_dict()
     end_time = time.time()
-    print(f"Precision: {precision}")
+    print(f"Accuracy: {metrics['accuracy']} Precision: {metrics['precision']} Coverage: {metrics['coverage']}")
+    print(f"Latency: {json.dumps(metrics['latency_ms'])}")
+    print(f"Per relation: {json.dumps(metrics['per_relation'])}")
     print(f"Computation time: {int((end_time - start_time) * 1000)} ms")
@@ -0,0 +1,104 @@
+import math
+from typing import Dict, Union
+
+
+class LatencyHistogram:
+    """LatencyHistogram - log-scale histogram with bounded memory, quantiles are accurate up to growth factor"""
+
+    def __init__(self, min_value_ms: float = 0.1, growth_factor: float = 1.05):
+        self.min_value_ms = min_value_ms
+        self.log_growth_factor = math.log(growth_factor)
+        self.growth_factor = growth_factor
+        self.buckets = {}
+        self.count = 0
+        self.max_value_ms = 0.0
+
+    def update(self, value_ms: float):
+        if value_ms <= self.min_value_ms:
+            index = 0
+        else:
+            index = math.ceil(math.log(value_ms / self.min_value_ms) / self.log_growth_factor)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.max_value_ms = max(self.max_value_ms, value_ms)
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # upper bound of bucket, but never more than the real maximum
+                return min(self.min_value_ms * self.growth_factor ** index, self.max_value_ms)
+        return self.max_value_ms
+
+
+class _Counts:
+    def __init__(self):
+        self.total = 0
+        self.answered = 0
+        self.correct = 0
+
+    def update(self, is_answered: bool, is_correct: bool):
+        self.total += 1
+        self.answered += int(is_answered)
+        self.correct += int(is_correct)
+
+    def to_dict(self) -> Dict:
+        return {
+            "total": self.total,
+            "answered": self.answered,
+            "correct": self.correct,
+            # accuracy over all questions, no answer is a wrong answer
+            # (equals micro precision which was computed with sklearn before)
+            "accuracy": self.correct / self.total if self.total else 0.0,
+            # precision over answered questions only
+            "precision": self.correct / self.answered if self.answered else 0.0,
+            "coverage": self.answered / self.total if self.total else 0.0,
+            "no_answer_rate": 1 - self.answered / self.total if self.total else 0.0,
+        }
+
+
+class StreamingMetrics:
+    """StreamingMetrics - metrics updated record by record, nothing but counters is kept in memory"""
+
+    def __init__(self):
+        self.overall = _Counts()
+        self.per_relation = {}
+        self.latency = LatencyHistogram()
+
+    def update(
+            self,
+            gold_entity: Union[str, None],
+            predicted_entity: Union[str, None],
+            relation: Union[str, None] = None,
+            latency_ms: Union[float, None] = None,
+    ):
+        is_answered = predicted_entity is not None
+        is_correct = is_answered and predicted_entity == gold_entity
+        self.overall.update(is_answered, is_correct)
+
+        if relation is not None:
+            if relation not in self.per_relation:
+                self.per_relation[relation] = _Counts()
+            self.per_relation[relation].update(is_answered, is_correct)
+
+        if latency_ms is not None:
+            self.latency.update(latency_ms)
+
+    def to_dict(self) -> Dict:
+        return {
+            **self.overall.to_dict(),
+            "latency_ms": {
+                "p50": self.latency.quantile(0.5),
+                "p90": self.latency.quantile(0.9),
+                "p99": self.latency.quantile(0.99),
+                "max": self.latency.max_value_ms,
+            },
+            "per_relation": {
+                relation: counts.to_dict()
+                for relation, counts in sorted(self.per_relation.items(), key=lambda x: x[1].total, reverse=True)
+            },
+        }
@@ -0,0 +1,105 @@
+import os
+from typing import Dict, Iterable, List
+
+SIGNATURE_TOP_K = 10
+STAGES = ("linking", "llm", "gather", "signature", "ranking", "total")
+REQUEST_STAGES = ("gather", "ranking")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("pyarrow is required for results export, install it with 'poetry install -E export'") from e
+    return pyarrow
+
+
+def results_schema():
+    pa = _import_pyarrow()
+    fields = [
+        ("question", pa.string()),
+        ("question_entity", pa.string()),
+        ("relation", pa.string()),
+        ("gold_entity", pa.string()),
+        ("predicted_entity", pa.string()),
+        ("is_correct", pa.bool_()),
+        ("answers_entities", pa.list_(pa.string())),
+        ("signature_top", pa.list_(pa.struct([
+            ("property", pa.string()),
+            ("entity", pa.string()),
+            ("count", pa.int32()),
+        ]))),
+        ("candidates_amount", pa.int32()),
+        ("best_score", pa.int64()),
+        ("score_margin", pa.int64()),
+    ]
+    fields += [(f"time_{stage}_ms", pa.float64()) for stage in STAGES]
+    for stage in REQUEST_STAGES:
+        fields += [(f"requests_{stage}", pa.int32()), (f"endpoint_requests_{stage}", pa.int32())]
+    return pa.schema(fields)
+
+
+def signature_top(signature_table, top_k: int = SIGNATURE_TOP_K) -> List[Dict]:
+    return [
+        {"property": connection_property, "entity": entity, "count": count}
+        for connection_property, (entity, count) in list(signature_table.items())[:top_k]
+    ]
+
+
+def score_summary(neighbours_score) -> Dict:
+    """Candidates amount, best score and margin to the second best from ordered score table"""
+    scores = list(neighbours_score.values())
+    return {
+        "candidates_amount": len(scores),
+        "best_score": scores[0] if scores else None,
+        "score_margin": scores[0] - scores[1] if len(scores) > 1 else None,
+    }
+
+
+class ParquetResultsSink:
+    """ParquetResultsSink - streams per question results to Parquet file, one row group per row_group_size rows"""
+
+    def __init__(self, filepath: str, row_group_size: int = 1000):
+        pa = _import_pyarrow()
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.schema = results_schema()
+        self.row_group_size = row_group_size
+        self._pa = pa
+        self._writer = pa.parquet.ParquetWriter(filepath, self.schema, compression="zstd")
+        self._rows = []
+
+    def write(self, row: Dict):
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        table = self._pa.Table.from_pylist(self._rows, schema=self.schema)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_results(filepaths: Iterable[str], columns: List[str] = None):
+    """Results of many runs as one pyarrow Table, 'run' column holds the file name of every row"""
+    pa = _import_pyarrow()
+    tables = []
+    for filepath in filepaths:
+        table = pa.parquet.read_table(filepath, columns=columns)
+        run = os.path.splitext(os.path.basename(filepath))[0]
+        tables.append(table.append_column("run", pa.array([run] * table.num_rows, pa.string())))
+    return pa.concat_tables(tables)
@@ -1,30 +1,53 @@
 from collections import OrderedDict
-from typing import Dict
+from typing import Dict, Union
 
 from joblib import Parallel, delayed
 
-from kgqa_signatures.config import DISABLE_PARALLEL
+from kgqa_signatures.config import DISABLE_PARALLEL, QUERY_PLANNER_ENABLED
+from kgqa_signatures.logger import get_log_context, set_log_context
+from kgqa_signatures.wikidata.api import get_request_counters
+from kgqa_signatures.wikidata.planner import find_question_entity_neighbours
 from kgqa_signatures.wikidata.service import get_entity_one_hop_neighbours, count_matches
 from kgqa_signatures.wikidata.sparql_condition import SparqlCondition
 
 
+def _get_neighbours_with_request_counters(entity_id, log_context=None):
+    # requests made in joblib workers are not visible to counters of the main process, so they are returned
+    if log_context is not None:
+        set_log_context(**log_context)
+    counters_before = get_request_counters()
+    connections = get_entity_one_hop_neighbours(entity_id)
+    counters_after = get_request_counters()
+    return connections, {key: counters_after[key] - counters_before[key] for key in counters_after}
+
+
 def __connections_gatherer_single(llm_predicted_answers_entities):
     for entity_id in llm_predicted_answers_entities:
-        yield get_entity_one_hop_neighbours(entity_id)
+        yield _get_neighbours_with_request_counters(entity_id)
 
 
-def gather_answers_connections(llm_predicted_answers_entities, n_jobs=4) -> Dict:
+def gather_answers_connections(
+        llm_predicted_answers_entities,
+        n_jobs=4,
+        request_counters: Union[Dict[str, int], None] = None,
+) -> Dict:
+    """Gather neighbours of all answers to common table, request_counters are incremented if given"""
     gathered_connections = {}
 
     if not DISABLE_PARALLEL:
         parallel = Parallel(n_jobs=n_jobs)
+        log_context = get_log_context()
         connections_gatherer = parallel(
-            delayed(get_entity_one_hop_neighbours)(entity_id) for entity_id in llm_predicted_answers_entities
+            delayed(_get_neighbours_with_request_counters)(entity_id, log_context)
+            for entity_id in llm_predicted_answers_entities
         )
     else:
         connections_gatherer = __connections_gatherer_single(llm_predicted_answers_entities)
 
-    for connections in connections_gatherer:
+    for connections, counters in connections_gatherer:
+        if request_counters is not None:
+            for key, value in counters.items():
+                request_counters[key] = request_counters.get(key, 0) + value
         for connection_property, connected_entity in connections:
             if connection_property not in gathered_connections:
                 gathered_connections[connection_property] = {}
@@ -77,13 +100,14 @@ def __score_neighbours_by_signature(question_entity_neighbours, signature_condit
     return score_table
 
 
-def find_neighbour_by_signature(
+def rank_neighbours_by_signature(
         signature_table: OrderedDict,
         question_entity,
         llm_predicted_answers_entities,
         top_n_signatures=0,
         take_all_signature_rules_with_full_match=True,
-):
+) -> OrderedDict:
+    """Neighbours of question entity with their signature scores, ordered by desc of score"""
     # get all neighbours of entity with signature
     signature_conditions = [
         SparqlCondition(connection=item[0], destination=item[1][0], union_with_invert=True)
@@ -99,24 +123,47 @@ def find_neighbour_by_signature(
         if (index < top_n_signatures)
            or (take_all_signature_rules_with_full_match and item[1][1] == len(llm_predicted_answers_entities))
     ]
-    question_entity_neighbours = get_entity_one_hop_neighbours(
-        question_entity,
-        direct_only=False,
-        conditions=signature_conditions,
-        match_all_conditions=False
-    )
+    if QUERY_PLANNER_ENABLED:
+        question_entity_neighbours = find_question_entity_neighbours(question_entity, signature_conditions)
+    else:
+        question_entity_neighbours = get_entity_one_hop_neighbours(
+            question_entity,
+            direct_only=False,
+            conditions=signature_conditions,
+            match_all_conditions=False
+        )
 
-    neighbours_score = __score_neighbours_by_signature(
+    return __score_neighbours_by_signature(
         question_entity_neighbours,
         signature_conditions,
         signature_condition_weights
     )
 
+
+def select_answer_entity(neighbours_score: OrderedDict):
+    """Best neighbour from rank_neighbours_by_signature, None if there are no neighbours"""
     # sort neighbours by signature rating and choose the best one
-    answer_entity = "Q0"  # not existing entity -- None is restricted because of precision calculation
+    answer_entity = None
     for neighbour, score in neighbours_score.items():
         # we just take the first one as they are ordered by desc of signature match
         answer_entity = neighbour
         break
 
     return answer_entity
+
+
+def find_neighbour_by_signature(
+        signature_table: OrderedDict,
+        question_entity,
+        llm_predicted_answers_entities,
+        top_n_signatures=0,
+        take_all_signature_rules_with_full_match=True,
+):
+    neighbours_score = rank_neighbours_by_signature(
+        signature_table,
+        question_entity,
+        llm_predicted_answers_entities,
+        top_n_signatures=top_n_signatures,
+        take_all_signature_rules_with_full_match=take_all_signature_rules_with_full_match
+    )
+    return select_answer_entity(neighbours_score)
@@ -0,0 +1,333 @@
+"""Maintenance of joblib cache written by FileSystemStoreBackendNoNumpy.
+
+    python -m kgqa_signatures.utils.cache_maintenance stats
+    python -m kgqa_signatures.utils.cache_maintenance evict --poisoned --stale --max-bytes 20G --policy lru
+    python -m kgqa_signatures.utils.cache_maintenance compact
+    python -m kgqa_signatures.utils.cache_maintenance export bundle.tar.gz --since "2023-10-01 12:00"
+    python -m kgqa_signatures.utils.cache_maintenance import bundle.tar.gz
+"""
+import datetime
+import io
+import json
+import os
+import pickle
+import re
+import shutil
+import tarfile
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Union
+
+from kgqa_signatures.config import CACHE_DIRECTORY, ENDPOINT_DATA_VERSION
+from kgqa_signatures.utils.joblib_memory_cache_backend import (
+    DATA_VERSION_FILENAME,
+    HITS_FILENAME,
+    HITS_SIZE,
+    decode_hits
+)
+
+OUTPUT_FILENAME = "output.pkl"
+FUNC_CODE_FILENAME = "func_code.py"
+BUNDLE_MANIFEST_FILENAME = "manifest.json"
+# temporary files of joblib concurrency safe write, left behind by killed processes
+JOBLIB_TEMPORARY_FILE_REGEX = re.compile(r".*\.thread-\d+-pid-\d+$")
+# younger temporary files and incomplete entries can be still written by a running process
+TEMPORARY_FILE_MIN_AGE = 3600
+POISONED_PICKLES = {pickle.dumps(None, protocol=protocol) for protocol in range(pickle.HIGHEST_PROTOCOL + 1)}
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+@dataclass
+class CacheEntry:
+    path: str
+    function: str
+    size_bytes: int
+    created: float
+    last_access: float
+    hits: int
+    data_version: Union[str, None]
+
+    @property
+    def is_poisoned(self) -> bool:
+        """Failed requests are cached as None"""
+        filename = os.path.join(self.path, OUTPUT_FILENAME)
+        if os.path.getsize(filename) > max(map(len, POISONED_PICKLES)):
+            return False
+        with open(filename, "rb") as f:
+            return f.read() in POISONED_PICKLES
+
+    def is_stale(self, data_version: Union[str, None] = ENDPOINT_DATA_VERSION) -> bool:
+        return data_version is not None and self.data_version != data_version
+
+
+def _read_entry(cache_directory: str, path: str, filenames: List[str]) -> CacheEntry:
+    output_stat = os.stat(os.path.join(path, OUTPUT_FILENAME))
+    hits = 0
+    last_access = output_stat.st_mtime
+    if HITS_FILENAME in filenames:
+        hits_filepath = os.path.join(path, HITS_FILENAME)
+        hits_stat = os.stat(hits_filepath)
+        with open(hits_filepath, "rb") as f:
+            hits = decode_hits(f.read(HITS_SIZE), hits_stat.st_size)
+        last_access = max(last_access, hits_stat.st_mtime)
+    data_version = None
+    if DATA_VERSION_FILENAME in filenames:
+        with open(os.path.join(path, DATA_VERSION_FILENAME)) as f:
+            data_version = f.read().strip()
+    return CacheEntry(
+        path=path,
+        function=os.path.relpath(os.path.dirname(path), cache_directory),
+        # hits counter is rewritten on every load, it is bookkeeping and not cached data
+        size_bytes=sum(
+            os.path.getsize(os.path.join(path, filename)) for filename in filenames if filename != HITS_FILENAME
+        ),
+        created=output_stat.st_mtime,
+        last_access=last_access,
+        hits=hits,
+        data_version=data_version,
+    )
+
+
+def iter_entries(cache_directory: str = CACHE_DIRECTORY) -> Iterable[CacheEntry]:
+    for path, _, filenames in os.walk(os.path.join(cache_directory, "joblib")):
+        if OUTPUT_FILENAME in filenames:
+            try:
+                yield _read_entry(cache_directory, path, filenames)
+            except OSError:
+                # entry removed by concurrent run
+                continue
+
+
+def collect_stats(cache_directory: str = CACHE_DIRECTORY, data_version: str = ENDPOINT_DATA_VERSION) -> Dict:
+    stats = {}
+    for entry in iter_entries(cache_directory):
+        if entry.function not in stats:
+            stats[entry.function] = {
+                "entries": 0,
+                "bytes": 0,
+                "hits": 0,
+                "never_hit_entries": 0,
+                "poisoned_entries": 0,
+                "stale_entries": 0,
+                "oldest": entry.created,
+                "last_access": entry.last_access,
+            }
+        function_stats = stats[entry.function]
+        function_stats["entries"] += 1
+        function_stats["bytes"] += entry.size_bytes
+        function_stats["hits"] += entry.hits
+        function_stats["never_hit_entries"] += int(entry.hits == 0)
+        function_stats["poisoned_entries"] += int(entry.is_poisoned)
+        function_stats["stale_entries"] += int(entry.is_stale(data_version))
+        function_stats["oldest"] = min(function_stats["oldest"], entry.created)
+        function_stats["last_access"] = max(function_stats["last_access"], entry.last_access)
+    return stats
+
+
+def evict(
+        cache_directory: str = CACHE_DIRECTORY,
+        max_bytes: Union[int, None] = None,
+        policy: str = "lru",
+        max_age_seconds: Union[float, None] = None,
+        poisoned: bool = False,
+        stale: bool = False,
+        data_version: str = ENDPOINT_DATA_VERSION,
+        dry_run: bool = False,
+) -> Dict[str, int]:
+    """Remove poisoned, stale and old entries, then the least recently used (policy 'lru')
+    or the oldest (policy 'age') ones until the cache fits into max_bytes"""
+    now = time.time()
+    kept = []
+    removed = {"entries": 0, "bytes": 0}
+
+    def remove(entry: CacheEntry):
+        if not dry_run:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        removed["entries"] += 1
+        removed["bytes"] += entry.size_bytes
+
+    for entry in iter_entries(cache_directory):
+        if (poisoned and entry.is_poisoned) \
+                or (stale and entry.is_stale(data_version)) \
+                or (max_age_seconds is not None and now - entry.created > max_age_seconds):
+            remove(entry)
+        else:
+            kept.append(entry)
+
+    if max_bytes is not None:
+        total_bytes = sum(entry.size_bytes for entry in kept)
+        kept.sort(key=lambda x: x.last_access if policy == "lru" else x.created)
+        for entry in kept:
+            if total_bytes <= max_bytes:
+                break
+            remove(entry)
+            total_bytes -= entry.size_bytes
+
+    return removed
+
+
+def compact(cache_directory: str = CACHE_DIRECTORY, dry_run: bool = False) -> Dict[str, int]:
+    """Remove leftovers: entries without output (interrupted writes) and joblib temporary files.
+
+    Lock files of in-flight requests are a fixed set of stripes and are kept.
+    """
+    removed = {"incomplete_entries": 0, "temporary_files": 0}
+    now = time.time()
+    for path, directories, filenames in os.walk(os.path.join(cache_directory, "joblib"), topdown=False):
+        for filename in filenames:
+            filepath = os.path.join(path, filename)
+            if JOBLIB_TEMPORARY_FILE_REGEX.match(filename) and now - os.path.getmtime(filepath) > TEMPORARY_FILE_MIN_AGE:
+                if not dry_run:
+                    os.remove(filepath)
+                removed["temporary_files"] += 1
+        # entry directory is a leaf with metadata but without output
+        if not directories and OUTPUT_FILENAME not in filenames and FUNC_CODE_FILENAME not in filenames \
+                and now - os.path.getmtime(path) > TEMPORARY_FILE_MIN_AGE:
+            if not dry_run:
+                shutil.rmtree(path, ignore_errors=True)
+            removed["incomplete_entries"] += 1
+    return removed
+
+
+def export_bundle(
+        bundle_filepath: str,
+        cache_directory: str = CACHE_DIRECTORY,
+        since: Union[float, None] = None,
+        min_hits: int = 0,
+        include_poisoned: bool = False,
+) -> int:
+    """Pack hot working set into tar.gz: entries accessed since timestamp (e.g. start of a run on dataset)
+    and hit at least min_hits times. Returns amount of exported entries."""
+    functions = set()
+    amount = 0
+    with tarfile.open(bundle_filepath, "w:gz") as bundle:
+        for entry in iter_entries(cache_directory):
+            if (since is not None and entry.last_access < since) or entry.hits < min_hits:
+                continue
+            if not include_poisoned and entry.is_poisoned:
+                continue
+            bundle.add(entry.path, arcname=os.path.relpath(entry.path, cache_directory))
+            functions.add(entry.function)
+            amount += 1
+
+        # joblib checks code of function before using its entries
+        for function in functions:
+            func_code_filepath = os.path.join(cache_directory, function, FUNC_CODE_FILENAME)
+            if os.path.exists(func_code_filepath):
+                bundle.add(func_code_filepath, arcname=os.path.join(function, FUNC_CODE_FILENAME))
+
+        manifest = json.dumps({
+            "entries": amount,
+            "data_version": ENDPOINT_DATA_VERSION,
+            "created": str(datetime.datetime.now()),
+        }).encode("utf-8")
+        manifest_info = tarfile.TarInfo(BUNDLE_MANIFEST_FILENAME)
+        manifest_info.size = len(manifest)
+        manifest_info.mtime = int(time.time())
+        bundle.addfile(manifest_info, io.BytesIO(manifest))
+    return amount
+
+
+def import_bundle(bundle_filepath: str, cache_directory: str = CACHE_DIRECTORY) -> int:
+    """Unpack bundle into cache, existing entries are kept. Returns amount of imported files."""
+    amount = 0
+    root = os.path.realpath(cache_directory)
+    with tarfile.open(bundle_filepath, "r:gz") as bundle:
+        for member in bundle.getmembers():
+            if member.name == BUNDLE_MANIFEST_FILENAME or not member.isfile():
+                continue
+            target = os.path.realpath(os.path.join(cache_directory, member.name))
+            if not target.startswith(root + os.sep):
+                raise ValueError(f"Unsafe path in cache bundle: {member.name}")
+            if os.path.exists(target):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with bundle.extractfile(member) as source, open(target, "wb") as destination:
+                shutil.copyfileobj(source, destination)
+            # keep original times, they are used by age and LRU eviction
+            os.utime(target, (member.mtime, member.mtime))
+            amount += 1
+    return amount
+
+
+def _parse_size(value: str) -> int:
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def _parse_since(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main(args):
+    if args.command == "stats":
+        stats = collect_stats(args.cache_directory)
+        for function, function_stats in stats.items():
+            function_stats["oldest"] = str(datetime.datetime.fromtimestamp(function_stats["oldest"]))
+            function_stats["last_access"] = str(datetime.datetime.fromtimestamp(function_stats["last_access"]))
+            print(f"{function}: {json.dumps(function_stats)}")
+        print(f"Total entries: {sum(x['entries'] for x in stats.values())}"
+              f" bytes: {sum(x['bytes'] for x in stats.values())}"
+              f" hits: {sum(x['hits'] for x in stats.values())}")
+    elif args.command == "evict":
+        removed = evict(
+            args.cache_directory,
+            max_bytes=_parse_size(args.max_bytes) if args.max_bytes is not None else None,
+            policy=args.policy,
+            max_age_seconds=args.max_age_days * 24 * 3600 if args.max_age_days is not None else None,
+            poisoned=args.poisoned,
+            stale=args.stale,
+            dry_run=args.dry_run,
+        )
+        print(f"Removed entries: {removed['entries']} bytes: {removed['bytes']}")
+    elif args.command == "compact":
+        print(f"Removed: {json.dumps(compact(args.cache_directory, dry_run=args.dry_run))}")
+    elif args.command == "export":
+        amount = export_bundle(
+            args.bundle,
+            args.cache_directory,
+            since=_parse_since(args.since) if args.since is not None else None,
+            min_hits=args.min_hits,
+        )
+        print(f"Exported entries: {amount}")
+    elif args.command == "import":
+        print(f"Imported files: {import_bundle(args.bundle, args.cache_directory)}")
+
+
+if __name__ == "__main__":
+    parse = ArgumentParser(description="Maintenance of Wikidata requests cache")
+    parse.add_argument("--cache-directory", default=CACHE_DIRECTORY, help="Cache directory")
+    commands = parse.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("stats", help="Entries, bytes and hits per cached function")
+
+    evict_parser = commands.add_parser("evict", help="Evict entries")
+    evict_parser.add_argument("--max-bytes", default=None, help="Byte budget, suffixes K, M, G, T are allowed")
+    evict_parser.add_argument("--policy", choices=["lru", "age"], default="lru", help="Order of eviction by budget")
+    evict_parser.add_argument("--max-age-days", default=None, type=float, help="Evict entries older than that")
+    evict_parser.add_argument("--poisoned", action="store_true", help="Evict failed requests cached as None")
+    evict_parser.add_argument(
+        "--stale", action="store_true", help="Evict entries not tied to config.ENDPOINT_DATA_VERSION"
+    )
+    evict_parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+
+    compact_parser = commands.add_parser("compact", help="Remove incomplete entries and temporary files")
+    compact_parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed")
+
+    export_parser = commands.add_parser("export", help="Export hot working set as tar.gz bundle")
+    export_parser.add_argument("bundle", help="Path to bundle")
+    export_parser.add_argument(
+        "--since", default=None, help="Only entries accessed since ISO datetime or unix time (e.g. start of run)"
+    )
+    export_parser.add_argument("--min-hits", default=0, type=int, help="Only entries hit at least that many times")
+
+    import_parser = commands.add_parser("import", help="Import tar.gz bundle into cache")
+    import_parser.add_argument("bundle", help="Path to bundle")
+
+    main(parse.parse_args())
@@ -6,6 +6,21 @@ import warnings
 from joblib import register_store_backend, numpy_pickle
 from joblib._store_backends import FileSystemStoreBackend, CacheWarning
 
+from kgqa_signatures.config import ENDPOINT_DATA_VERSION
+
+# bookkeeping of cache maintenance, stored next to output.pkl of every item
+HITS_FILENAME = "hits"
+HITS_SIZE = 8
+DATA_VERSION_FILENAME = "data_version"
+
+
+def decode_hits(data: bytes, file_size: int) -> int:
+    """Value of hits counter from first HITS_SIZE bytes and size of its file"""
+    if file_size == HITS_SIZE and data[:HITS_SIZE] != b"." * HITS_SIZE:
+        return int.from_bytes(data[:HITS_SIZE], "little")
+    # empty or written by older versions, which appended one "." per hit
+    return file_size
+
 
 class FileSystemStoreBackendNoNumpy(FileSystemStoreBackend):
     NAME = "no_numpy"
@@ -35,8 +50,27 @@ class FileSystemStoreBackendNoNumpy(FileSystemStoreBackend):
                 item = pickle.load(f)
         else:
             item = numpy_pickle.load(filename, mmap_mode=mmap_mode)
+        self._record_hit(full_path)
         return item
 
+    @staticmethod
+    def _record_hit(item_path):
+        # fixed size counter, last hit is its mtime; a concurrent hit can be lost, it is only a hint for eviction
+        try:
+            fd = os.open(os.path.join(item_path, HITS_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return
+        try:
+            file_size = os.fstat(fd).st_size
+            hits = decode_hits(os.pread(fd, HITS_SIZE, 0), file_size)
+            os.pwrite(fd, (hits + 1).to_bytes(HITS_SIZE, "little"), 0)
+            if file_size > HITS_SIZE:
+                os.ftruncate(fd, HITS_SIZE)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
     def dump_item(self, path, item, verbose=1):
         """Dump an item in the store at the path given as a list of
            strings."""
@@ -67,6 +101,9 @@ class FileSystemStoreBackendNoNumpy(FileSystemStoreBackend):
                         )
 
             self._concurrency_safe_write(item, filename, write_func)
+            if ENDPOINT_DATA_VERSION is not None:
+                with open(os.path.join(item_path, DATA_VERSION_FILENAME), "w") as f:
+                    f.write(ENDPOINT_DATA_VERSION)
         except Exception as e:  # noqa: E722
             warnings.warn(
                 "Unable to cache to disk. Possibly a race condition in the "
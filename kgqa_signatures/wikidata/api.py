@@ -1,4 +1,9 @@
+import fcntl
+import hashlib
+import os
+import threading
 import time
+from contextlib import contextmanager
 from http.client import RemoteDisconnected
 
 import requests
@@ -8,16 +13,123 @@ from urllib3.exceptions import ProtocolError
 from kgqa_signatures.config import (
     CACHE_DIRECTORY,
     MEDIAWIKI_API_URL,
-    SPARQL_API_URL
+    SPARQL_API_EJECT_SECONDS,
+    SPARQL_API_MAX_FAILURES,
+    SPARQL_API_URL,
+    SPARQL_API_URLS
 )
 from kgqa_signatures.logger import get_logger
 from kgqa_signatures.utils.joblib_memory_cache_backend import FileSystemStoreBackendNoNumpy
+from kgqa_signatures.wikidata.endpoint_pool import EndpointPool
 
 logger = get_logger()
 memory = Memory(CACHE_DIRECTORY, verbose=0, backend=FileSystemStoreBackendNoNumpy.NAME)
+INFLIGHT_DIRECTORY = os.path.join(CACHE_DIRECTORY, "inflight")
+# fixed set of lock files shared by all requests, so no file is left per request
+INFLIGHT_LOCK_STRIPES = 256
+# outstanding requests are shared by all processes routing across the same replicas
+ENDPOINT_POOL_STATE_FILEPATH = os.path.join(
+    CACHE_DIRECTORY,
+    "endpoint_pool",
+    hashlib.sha1("\n".join(SPARQL_API_URLS).encode("utf-8")).hexdigest() + ".state"
+)
+endpoint_pool = EndpointPool(
+    SPARQL_API_URLS,
+    max_failures=SPARQL_API_MAX_FAILURES,
+    eject_seconds=SPARQL_API_EJECT_SECONDS,
+    state_filepath=ENDPOINT_POOL_STATE_FILEPATH
+)
+# replica is considered unhealthy on these codes, request is repeated on another one
+UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+
+_inflight_locks = {}
+_inflight_locks_guard = threading.Lock()
+# requests issued by this process: all of them and only those which went to the endpoint
+_request_counters = {"requests": 0, "endpoint_requests": 0}
+_request_counters_lock = threading.Lock()
+
+
+def get_request_counters():
+    with _request_counters_lock:
+        return dict(_request_counters)
+
+
+def _increment_request_counter(key):
+    with _request_counters_lock:
+        _request_counters[key] += 1
+
+
+def get_request_hash(request: str) -> str:
+    return hashlib.sha1(request.encode("utf-8")).hexdigest()
+
+
+def execute_pooled_request(params, headers):
+    # "Send request to Wikidata" is logged without replica, it is joined with records below by request hash
+    request_hash = get_request_hash(params["query"])
+    tried_urls = []
+    for _ in range(len(endpoint_pool)):
+        api_url = endpoint_pool.acquire(exclude=tried_urls)
+        tried_urls.append(api_url)
+        logger.info(
+            {
+                "msg": "Send request to SPARQL replica",
+                "request_hash": request_hash,
+                "endpoint": api_url,
+            }
+        )
+        try:
+            response = execute_wiki_request_with_delays(api_url, params, headers)
+        except (ProtocolError, RemoteDisconnected, requests.exceptions.ConnectionError) as e:
+            endpoint_pool.release(api_url, failed=True)
+            if len(tried_urls) == len(endpoint_pool):
+                logger.error(
+                    {
+                        "msg": "Request failed on all SPARQL replicas",
+                        "exception": str(e),
+                        "request_hash": request_hash,
+                        "tried_urls": tried_urls,
+                    }
+                )
+                raise e
+            logger.warning(
+                {
+                    "msg": "Request to SPARQL replica failed. Retry on another one.",
+                    "exception": str(e),
+                    "request_hash": request_hash,
+                    "endpoint": api_url,
+                }
+            )
+            continue
+
+        failed = response.status_code in UNAVAILABLE_STATUS_CODES
+        endpoint_pool.release(api_url, failed=failed)
+        if not failed:
+            return response
+        if len(tried_urls) == len(endpoint_pool):
+            logger.error(
+                {
+                    "msg": "Request failed on all SPARQL replicas",
+                    "status_code": response.status_code,
+                    "request_hash": request_hash,
+                    "tried_urls": tried_urls,
+                }
+            )
+            return response
+        logger.warning(
+            {
+                "msg": "Request to SPARQL replica failed. Retry on another one.",
+                "status_code": response.status_code,
+                "request_hash": request_hash,
+                "endpoint": api_url,
+            }
+        )
 
 
 def execute_wiki_request_with_delays(api_url, params, headers):
+    if api_url is None:
+        return execute_pooled_request(params, headers)
+
+    start_time = time.time()
     response = requests.get(
         api_url,
         params=params,
@@ -47,6 +159,14 @@ def execute_wiki_request_with_delays(api_url, params, headers):
             headers=headers,
         )
 
+    logger.info(
+        {
+            "msg": "SPARQL endpoint request timing",
+            "endpoint": api_url,
+            "status_code": response.status_code,
+            "elapsed_ms": int((time.time() - start_time) * 1000),
+        }
+    )
     return response
 
 
@@ -102,3 +222,51 @@ def execute_sparql_request(request: str, api_url: str = SPARQL_API_URL):
             }
         )
         raise e
+
+
+# joblib keeps cache of function by its module and name and clears it when the source changes,
+# so the memoized function above is kept untouched and wrapped under the same name
+_cached_execute_sparql_request = execute_sparql_request
+
+
+@contextmanager
+def _single_flight(request: str):
+    """Serialize identical requests: within process by thread lock, across workers by lock file.
+
+    Requests with the same lock stripe are serialized across workers too, which is rare with 256 stripes.
+    """
+    key = get_request_hash(request)
+    with _inflight_locks_guard:
+        if key not in _inflight_locks:
+            _inflight_locks[key] = [threading.Lock(), 0]
+        _inflight_locks[key][1] += 1
+        thread_lock = _inflight_locks[key][0]
+
+    try:
+        with thread_lock:
+            os.makedirs(INFLIGHT_DIRECTORY, exist_ok=True)
+            stripe = int(key, 16) % INFLIGHT_LOCK_STRIPES
+            with open(os.path.join(INFLIGHT_DIRECTORY, f"{stripe:02x}.lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        with _inflight_locks_guard:
+            _inflight_locks[key][1] -= 1
+            if _inflight_locks[key][1] == 0:
+                del _inflight_locks[key]
+
+
+def execute_sparql_request(request: str, api_url: str = None):  # noqa: F811
+    """Cached SPARQL request, without api_url it is routed across SPARQL_API_URLS replicas"""
+    _increment_request_counter("requests")
+    if _cached_execute_sparql_request.check_call_in_cache(request):
+        return _cached_execute_sparql_request(request, api_url)
+
+    with _single_flight(request):
+        # if an identical request was in flight, its result is in cache now and no request is sent
+        if not _cached_execute_sparql_request.check_call_in_cache(request):
+            _increment_request_counter("endpoint_requests")
+        return _cached_execute_sparql_request(request, api_url)
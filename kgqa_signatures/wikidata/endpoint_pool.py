@@ -0,0 +1,230 @@
+import fcntl
+import mmap
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, List, Union
+
+import requests
+
+from kgqa_signatures.logger import get_logger
+
+logger = get_logger()
+
+HEALTH_CHECK_QUERY = "ASK {}"
+HEALTH_CHECK_TIMEOUT = 5
+OUTSTANDING_SLOTS = 128
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedOutstandingCounters:
+    """SharedOutstandingCounters - outstanding requests per replica, visible to all processes (joblib workers).
+
+    Memory-mapped file holds a slot per process: its pid followed by its counters per replica.
+    A process changes only its own slot and slots of dead processes are ignored and reused,
+    so requests of a killed worker are not counted forever.
+    """
+
+    def __init__(self, filepath: str, replicas_amount: int, slots: int = OUTSTANDING_SLOTS):
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.replicas_amount = replicas_amount
+        self.slots = slots
+        self.slot_size = 1 + replicas_amount
+        self._file = open(filepath, "a+b")
+        with self._file_lock():
+            size = slots * self.slot_size * 8
+            if os.fstat(self._file.fileno()).st_size < size:
+                self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), slots * self.slot_size * 8)
+        self._values = memoryview(self._mmap).cast("q")
+        self._slot = None
+        self._slot_pid = None
+        # used when all slots are taken by other processes
+        self._local = [0] * replicas_amount
+
+    @contextmanager
+    def _file_lock(self):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _own_slot(self):
+        pid = os.getpid()
+        if self._slot_pid == pid:
+            return self._slot
+        # slot is claimed lazily and again after fork
+        self._slot_pid = pid
+        self._slot = None
+        with self._file_lock():
+            for slot in range(self.slots):
+                base = slot * self.slot_size
+                owner = self._values[base]
+                if owner == 0 or not _is_process_alive(owner):
+                    self._values[base] = pid
+                    for index in range(self.replicas_amount):
+                        self._values[base + 1 + index] = 0
+                    self._slot = slot
+                    break
+        return self._slot
+
+    def add(self, replica_index: int, delta: int):
+        slot = self._own_slot()
+        if slot is None:
+            self._local[replica_index] += delta
+        else:
+            self._values[slot * self.slot_size + 1 + replica_index] += delta
+
+    def totals(self) -> List[int]:
+        self._own_slot()
+        totals = list(self._local)
+        for slot in range(self.slots):
+            base = slot * self.slot_size
+            owner = self._values[base]
+            if owner == 0:
+                continue
+            counts = self._values[base + 1:base + self.slot_size].tolist()
+            if any(counts) and owner != self._slot_pid and not _is_process_alive(owner):
+                continue
+            for index, count in enumerate(counts):
+                totals[index] += count
+        return totals
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None
+
+
+class EndpointPool:
+    """EndpointPool - least outstanding requests routing across SPARQL replicas.
+
+    A replica is ejected after max_failures consecutive failures and re-admitted
+    once eject_seconds passed and a health check query succeeds. With state_filepath
+    outstanding requests are counted across all processes using it (joblib workers),
+    otherwise only within the process; ties are broken randomly. Ejection state is
+    kept per process.
+    """
+
+    def __init__(
+            self,
+            urls: Iterable[str],
+            max_failures: int = 3,
+            eject_seconds: float = 30.0,
+            state_filepath: Union[str, None] = None,
+    ):
+        self.endpoints = [Endpoint(url) for url in urls]
+        if not self.endpoints:
+            raise ValueError("EndpointPool requires at least one endpoint")
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.lock = threading.Lock()
+        self.state_filepath = state_filepath
+        self._shared_outstanding = None
+
+    def _outstanding(self) -> List[int]:
+        if self.state_filepath is None:
+            return [endpoint.outstanding for endpoint in self.endpoints]
+        if self._shared_outstanding is None:
+            # opened lazily, so that every joblib worker maps the file itself
+            self._shared_outstanding = SharedOutstandingCounters(self.state_filepath, len(self.endpoints))
+        return self._shared_outstanding.totals()
+
+    def _add_outstanding(self, endpoint: Endpoint, delta: int):
+        endpoint.outstanding += delta
+        if self._shared_outstanding is not None:
+            self._shared_outstanding.add(self.endpoints.index(endpoint), delta)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def acquire(self, exclude: Union[List[str], None] = None) -> str:
+        """Choose replica for the next request, it must be given back by release"""
+        exclude = exclude or []
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.url not in exclude]
+            if not candidates:
+                candidates = self.endpoints
+            now = time.time()
+            to_check = [
+                endpoint for endpoint in candidates
+                if endpoint.ejected_until is not None and endpoint.ejected_until <= now
+            ]
+            # other threads keep skipping replica while it is checked
+            for endpoint in to_check:
+                endpoint.ejected_until = now + self.eject_seconds
+
+        # health check is a blocking request, so it is done without holding the lock
+        healthy = [endpoint for endpoint in to_check if self._health_check(endpoint.url)]
+
+        with self.lock:
+            for endpoint in healthy:
+                endpoint.ejected_until = None
+                endpoint.consecutive_failures = 0
+                logger.info({"msg": "SPARQL endpoint re-admitted to pool", "endpoint": endpoint.url})
+            admitted = [endpoint for endpoint in candidates if endpoint.ejected_until is None]
+            if not admitted:
+                # all replicas are ejected, the one which is going to be back first is the best guess
+                admitted = [min(candidates, key=lambda x: x.ejected_until)]
+            outstanding = dict(zip(map(id, self.endpoints), self._outstanding()))
+            min_outstanding = min(outstanding[id(endpoint)] for endpoint in admitted)
+            endpoint = random.choice(
+                [endpoint for endpoint in admitted if outstanding[id(endpoint)] == min_outstanding]
+            )
+            self._add_outstanding(endpoint, 1)
+            return endpoint.url
+
+    def release(self, url: str, failed: bool = False):
+        with self.lock:
+            endpoint = self._get(url)
+            self._add_outstanding(endpoint, -1)
+            if not failed:
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.max_failures and len(self.endpoints) > 1:
+                endpoint.ejected_until = time.time() + self.eject_seconds
+                logger.warning(
+                    {
+                        "msg": "SPARQL endpoint ejected from pool",
+                        "endpoint": url,
+                        "consecutive_failures": endpoint.consecutive_failures,
+                        "eject_seconds": self.eject_seconds,
+                    }
+                )
+
+    def _get(self, url: str) -> Endpoint:
+        for endpoint in self.endpoints:
+            if endpoint.url == url:
+                return endpoint
+        raise KeyError(url)
+
+    @staticmethod
+    def _health_check(url: str) -> bool:
+        try:
+            response = requests.get(
+                url,
+                params={"format": "json", "query": HEALTH_CHECK_QUERY},
+                headers={"Accept": "application/sparql-results+json"},
+                timeout=HEALTH_CHECK_TIMEOUT,
+            )
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
@@ -0,0 +1,240 @@
+import bz2
+import fcntl
+import gzip
+import mmap
+import os
+import re
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from typing import Iterable, List, Set, Tuple, Union
+
+from kgqa_signatures.config import ENTITY_FILTER_DIRECTORY
+from kgqa_signatures.logger import get_logger
+from kgqa_signatures.wikidata.api import execute_sparql_request
+
+logger = get_logger()
+
+# items (Qxxx) and properties (Pxxx) are indexed by separate bitsets, both can have instance of (P31)
+ENTITY_KINDS = ("Q", "P")
+TYPED_BITSET_FILENAMES = {"Q": "typed.bitset", "P": "typed_properties.bitset"}
+CHECKED_BITSET_FILENAMES = {"Q": "checked.bitset", "P": "checked_properties.bitset"}
+COMPLETE_MARKER_FILENAME = "complete"
+LOCK_FILENAME = "lock"
+FETCH_BATCH_SIZE = 500
+MIN_BITSET_SIZE = 1 << 20
+
+ENTITY_URI_REGEX = re.compile(r"^http://www\.wikidata\.org/entity/([QqPp])(\d+)$")
+DUMP_TYPED_ENTITY_REGEX = re.compile(
+    r"^<http://www\.wikidata\.org/entity/([QP])(\d+)> <http://www\.wikidata\.org/prop/direct/P31> "
+)
+
+
+def parse_entity(entity: str) -> Union[Tuple[str, int], None]:
+    """Kind (Q or P) and numeric part of entity, given as Qxxx/Pxxx or as full entity uri; None for everything else"""
+    match = ENTITY_URI_REGEX.match(entity)
+    if match is not None:
+        return match.group(1).upper(), int(match.group(2))
+    if entity[:1].upper() in ENTITY_KINDS and entity[1:].isdigit():
+        return entity[:1].upper(), int(entity[1:])
+    return None
+
+
+class QidBitset:
+    """QidBitset - memory-mapped bitset indexed by the numeric part of QID.
+
+    The file grows on demand, other processes pick up the new size on the next miss.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._file = open(filepath, "a+b")
+        self._mmap = None
+        self._size = 0
+        self._remap()
+
+    def _remap(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if size == self._size:
+            return
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = mmap.mmap(self._file.fileno(), size) if size > 0 else None
+        self._size = size
+
+    def __contains__(self, number: int) -> bool:
+        byte_index = number >> 3
+        if byte_index >= self._size:
+            self._remap()
+            if byte_index >= self._size:
+                return False
+        return bool(self._mmap[byte_index] & (1 << (number & 7)))
+
+    def add(self, number: int):
+        """Set bit for number; writers must be serialized by the caller"""
+        byte_index = number >> 3
+        if byte_index >= self._size:
+            self._remap()
+        if byte_index >= self._size:
+            self._file.truncate(max(byte_index + 1, self._size * 2, MIN_BITSET_SIZE))
+            self._remap()
+        self._mmap[byte_index] |= 1 << (number & 7)
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+
+class TypedEntityFilter:
+    """TypedEntityFilter - client-side replacement of the '?object wdt:P31 ?smth' join.
+
+    Keeps, for items and for properties, bitsets of typed entities and of entities already
+    checked against the endpoint. When built from a dump the filter is complete and
+    the checked bitsets are not used.
+    """
+
+    def __init__(self, directory: str = ENTITY_FILTER_DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.is_complete = os.path.exists(os.path.join(directory, COMPLETE_MARKER_FILENAME))
+        self.typed = {
+            kind: QidBitset(os.path.join(directory, TYPED_BITSET_FILENAMES[kind])) for kind in ENTITY_KINDS
+        }
+        self.checked = None if self.is_complete else {
+            kind: QidBitset(os.path.join(directory, CHECKED_BITSET_FILENAMES[kind])) for kind in ENTITY_KINDS
+        }
+
+    @contextmanager
+    def _write_lock(self):
+        with open(os.path.join(self.directory, LOCK_FILENAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def filter(self, entities: Iterable[str]) -> Set[str]:
+        """Subset of entities (Qxxx, Pxxx or entity uri) which have instance of (P31) property"""
+        parsed_entities = {}
+        for entity in entities:
+            parsed_entity = parse_entity(entity)
+            if parsed_entity is not None:
+                parsed_entities[entity] = parsed_entity
+
+        if not self.is_complete:
+            unchecked = {
+                (kind, number) for kind, number in parsed_entities.values() if number not in self.checked[kind]
+            }
+            if unchecked:
+                self._gather(sorted(unchecked))
+
+        return {entity for entity, (kind, number) in parsed_entities.items() if number in self.typed[kind]}
+
+    def _gather(self, parsed_entities: List[Tuple[str, int]]):
+        for start in range(0, len(parsed_entities), FETCH_BATCH_SIZE):
+            batch = parsed_entities[start:start + FETCH_BATCH_SIZE]
+            typed_entities = fetch_typed_entities(batch)
+            if typed_entities is None:
+                # leave batch unchecked, it will be requested again next time
+                continue
+            with self._write_lock():
+                # typed bit goes first, so an entity is never seen as checked but not typed
+                for kind, number in typed_entities:
+                    self.typed[kind].add(number)
+                for kind, number in batch:
+                    self.checked[kind].add(number)
+
+
+def fetch_typed_entities(parsed_entities: Iterable[Tuple[str, int]]) -> Union[Set[Tuple[str, int]], None]:
+    rendered_entities = " ".join(f"wd:{kind}{number}" for kind, number in parsed_entities)
+    sparql_query = """
+PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+PREFIX wd: <http://www.wikidata.org/entity/>
+SELECT DISTINCT ?object
+WHERE {
+    VALUES ?object { <ENTITIES> }
+    ?object wdt:P31 ?smth.
+}""".replace("<ENTITIES>", rendered_entities)
+    result = execute_sparql_request(sparql_query)
+
+    if result is None:
+        logger.error(
+            {
+                "msg": "cached request was with error",
+                "query": sparql_query,
+            }
+        )
+        return None
+
+    typed_entities = set()
+    for item in result:
+        parsed_entity = parse_entity(item["object"]["value"])
+        if parsed_entity is not None:
+            typed_entities.add(parsed_entity)
+    return typed_entities
+
+
+_entity_filter = None
+
+
+def get_entity_filter() -> TypedEntityFilter:
+    # opened lazily in every process, memory maps can't be shared with joblib workers by pickling
+    global _entity_filter
+    if _entity_filter is None:
+        _entity_filter = TypedEntityFilter()
+    return _entity_filter
+
+
+def _open_dump(dump_filepath: str):
+    if dump_filepath.endswith(".gz"):
+        return gzip.open(dump_filepath, "rt", encoding="utf-8")
+    if dump_filepath.endswith(".bz2"):
+        return bz2.open(dump_filepath, "rt", encoding="utf-8")
+    return open(dump_filepath, "r", encoding="utf-8")
+
+
+def build_typed_entity_filter(dump_filepath: str, directory: str = ENTITY_FILTER_DIRECTORY) -> int:
+    """Build complete filter from truthy N-Triples dump (latest-truthy.nt[.gz|.bz2]).
+
+    Returns amount of typed entities.
+    """
+    os.makedirs(directory, exist_ok=True)
+    filenames = [COMPLETE_MARKER_FILENAME] + list(TYPED_BITSET_FILENAMES.values()) \
+        + list(CHECKED_BITSET_FILENAMES.values())
+    for filename in filenames:
+        filepath = os.path.join(directory, filename)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    typed = {kind: QidBitset(os.path.join(directory, TYPED_BITSET_FILENAMES[kind])) for kind in ENTITY_KINDS}
+    amount = 0
+    with _open_dump(dump_filepath) as dump_file:
+        for line in dump_file:
+            match = DUMP_TYPED_ENTITY_REGEX.match(line)
+            if match is None:
+                continue
+            kind, number = match.group(1), int(match.group(2))
+            if number not in typed[kind]:
+                typed[kind].add(number)
+                amount += 1
+    for bitset in typed.values():
+        bitset.flush()
+        bitset.close()
+
+    # marker is written last, so an interrupted build stays a lazy (incomplete) filter
+    open(os.path.join(directory, COMPLETE_MARKER_FILENAME), "w").close()
+    return amount
+
+
+if __name__ == "__main__":
+    parse = ArgumentParser(description="Build bitset of typed Wikidata entities from truthy N-Triples dump")
+    parse.add_argument("dump_filepath", help="Path to latest-truthy.nt, optionally .gz or .bz2 compressed")
+    parse.add_argument("--directory", default=ENTITY_FILTER_DIRECTORY, help="Directory of entity filter")
+    args = parse.parse_args()
+    typed_amount = build_typed_entity_filter(args.dump_filepath, args.directory)
+    print(f"Typed entities: {typed_amount}")
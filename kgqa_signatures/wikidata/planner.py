@@ -0,0 +1,256 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from kgqa_signatures.config import QUERY_PLANNER_DEGREE_CAP
+from kgqa_signatures.logger import get_logger
+from kgqa_signatures.wikidata.api import get_request_counters
+from kgqa_signatures.wikidata.service import (
+    get_condition_degree,
+    get_condition_members,
+    get_entity_degree,
+    get_entity_one_hop_neighbours
+)
+from kgqa_signatures.wikidata.sparql_condition import SparqlCondition
+
+logger = get_logger()
+
+RESTRICT_BATCH_SIZE = 500
+
+# ways to join members of selective conditions with neighbours of the question entity
+BOUND_LOOKUP = "bound_lookup"
+CLIENT_INTERSECTION = "client_intersection"
+
+
+@dataclass
+class NeighbourLookupPlan:
+    """NeighbourLookupPlan - how to get neighbours of question entity matched by any of conditions.
+
+    Unselective conditions stay merged (UNION) in one query started from question entity,
+    selective ones are evaluated first and joined with question entity neighbours
+    either by a VALUES-bound lookup or by intersection on the client.
+
+    Costs are rows probed by the endpoint and include degree queries of planning itself,
+    baseline_cost is the single UNION query used without planner. As rows probed can't be
+    measured, estimated_rows (rows received) is what is checked against the execution.
+    """
+    question_entity: str
+    question_entity_degree: int
+    # degree statistics are counted up to cap, a capped degree means "at least cap"
+    question_entity_degree_is_capped: bool = False
+    merged_conditions: List[SparqlCondition] = field(default_factory=list)
+    merged_conditions_degrees: List[int] = field(default_factory=list)
+    member_conditions: List[SparqlCondition] = field(default_factory=list)
+    member_conditions_degrees: List[int] = field(default_factory=list)
+    members_join: str = BOUND_LOOKUP
+    planning_cost: int = 0
+    baseline_cost: int = 0
+    estimated_cost: int = 0
+    estimated_rows: int = 0
+    # degree queries, as recorded by _run_step
+    planning_steps: List[Dict] = field(default_factory=list)
+
+
+def _condition_to_str(condition: SparqlCondition) -> str:
+    return f"{condition.connection}:{condition.destination}"
+
+
+def _run_step(steps: List[Dict], step: Dict, function, *args, **kwargs):
+    """Call service function issuing one query and record rows received and time spent on it"""
+    endpoint_requests = get_request_counters()["endpoint_requests"]
+    start_time = time.time()
+    result = function(*args, **kwargs)
+    step["rows"] = len(result) if isinstance(result, (list, dict)) else 1
+    step["elapsed_ms"] = int((time.time() - start_time) * 1000)
+    # 0 when the query was answered from cache
+    step["endpoint_requests"] = get_request_counters()["endpoint_requests"] - endpoint_requests
+    steps.append(step)
+    return result
+
+
+def plan_neighbour_lookup(
+        question_entity: str,
+        conditions: List[SparqlCondition],
+        degree_cap: int = QUERY_PLANNER_DEGREE_CAP,
+) -> NeighbourLookupPlan:
+    planning_steps = []
+    question_entity_degree = _run_step(
+        planning_steps, {"step": "question_entity_degree"}, get_entity_degree, question_entity, degree_cap
+    )
+    plan = NeighbourLookupPlan(
+        question_entity,
+        question_entity_degree,
+        question_entity_degree >= degree_cap,
+        planning_steps=planning_steps
+    )
+    # COUNT query probes as many rows as it counts
+    plan.planning_cost = question_entity_degree
+    if not conditions:
+        plan.baseline_cost = question_entity_degree
+        plan.estimated_cost = plan.planning_cost + question_entity_degree
+        plan.estimated_rows = len(planning_steps) + question_entity_degree
+        return plan
+
+    conditions_with_degree = [
+        (
+            condition,
+            _run_step(
+                planning_steps,
+                {"step": "condition_degree", "condition": _condition_to_str(condition)},
+                get_condition_degree,
+                condition,
+                degree_cap
+            )
+        )
+        for condition in conditions
+    ]
+    plan.planning_cost += sum(degree for _, degree in conditions_with_degree)
+    # the same query without planner: every neighbour of question entity is probed against every condition
+    plan.baseline_cost = question_entity_degree * len(conditions)
+    # most selective conditions go first
+    conditions_with_degree.sort(key=lambda x: x[1])
+    for condition, degree in conditions_with_degree:
+        # members of condition are fetched and then probed against question entity: ~2 * degree,
+        # otherwise every neighbour of question entity is probed against condition: ~question entity degree
+        if degree < degree_cap and 2 * degree < question_entity_degree:
+            plan.member_conditions.append(condition)
+            plan.member_conditions_degrees.append(degree)
+        else:
+            plan.merged_conditions.append(condition)
+            plan.merged_conditions_degrees.append(degree)
+
+    members_cost = sum(plan.member_conditions_degrees)
+    join_cost = 0
+    join_rows = 0
+    if plan.member_conditions:
+        # when the question entity neighbourhood is smaller than all members it is cheaper to take it whole,
+        # but only if its size is known: the whole neighbourhood of a hub is unbounded
+        if plan.merged_conditions or plan.question_entity_degree_is_capped or members_cost <= question_entity_degree:
+            plan.members_join = BOUND_LOOKUP
+            join_cost = members_cost
+            join_rows = min(members_cost, question_entity_degree)
+        else:
+            plan.members_join = CLIENT_INTERSECTION
+            join_cost = question_entity_degree
+            join_rows = question_entity_degree
+    merged_cost = question_entity_degree * len(plan.merged_conditions)
+    plan.estimated_cost = plan.planning_cost + merged_cost + members_cost + join_cost
+
+    # a degree query returns one row, members are received as they are counted,
+    # merged and bound lookups return no more neighbours than either side of the join
+    merged_rows = min(question_entity_degree, sum(plan.merged_conditions_degrees))
+    plan.estimated_rows = len(planning_steps) + merged_rows + members_cost + join_rows
+    return plan
+
+
+def execute_neighbour_lookup_plan(plan: NeighbourLookupPlan) -> Tuple[List[Tuple[str, str]], List[Dict]]:
+    """Returns neighbours as (property, entity) pairs and executed steps (one query each, see _run_step)"""
+    neighbours = []
+    steps = []
+
+    if plan.merged_conditions or not plan.member_conditions:
+        merged_neighbours = _run_step(
+            steps,
+            {"step": "merged_neighbours"},
+            get_entity_one_hop_neighbours,
+            plan.question_entity,
+            direct_only=False,
+            conditions=plan.merged_conditions,
+            match_all_conditions=False
+        )
+        neighbours.extend(merged_neighbours)
+
+    if plan.member_conditions:
+        members = []
+        for condition in plan.member_conditions:
+            members.extend(
+                _run_step(
+                    steps,
+                    {"step": "condition_members", "condition": _condition_to_str(condition)},
+                    get_condition_members,
+                    condition
+                )
+            )
+        members = list(dict.fromkeys(members))
+
+        if plan.members_join == CLIENT_INTERSECTION:
+            all_neighbours = _run_step(
+                steps,
+                {"step": "all_neighbours"},
+                get_entity_one_hop_neighbours,
+                plan.question_entity,
+                direct_only=False
+            )
+            members_set = set(members)
+            neighbours.extend(item for item in all_neighbours if item[1] in members_set)
+        else:
+            for start in range(0, len(members), RESTRICT_BATCH_SIZE):
+                bound_neighbours = _run_step(
+                    steps,
+                    {"step": "bound_neighbours"},
+                    get_entity_one_hop_neighbours,
+                    plan.question_entity,
+                    direct_only=False,
+                    restrict_to=members[start:start + RESTRICT_BATCH_SIZE]
+                )
+                neighbours.extend(bound_neighbours)
+
+    # the same neighbour can be matched by merged and member conditions
+    neighbours = list(dict.fromkeys(neighbours))
+    # order of rows depends on the plan, while the first of equally scored candidates is taken as answer,
+    # so neighbours are ordered by QID to make ties independent of the plan
+    neighbours.sort(key=_neighbour_sort_key)
+    return neighbours, steps
+
+
+def _neighbour_sort_key(neighbour: Tuple[str, str]):
+    connection_property, connected_entity = neighbour
+    number = connected_entity[1:]
+    # items first, then property entities, each by numeric id
+    return (
+        connected_entity[:1] != "Q",
+        int(number) if number.isdigit() else float("inf"),
+        connected_entity,
+        connection_property
+    )
+
+
+def find_question_entity_neighbours(question_entity: str, conditions: List[SparqlCondition]) -> List[Tuple[str, str]]:
+    """Planned equivalent of get_entity_one_hop_neighbours(..., match_all_conditions=False).
+
+    The set of neighbours is the same, but they are ordered by QID, so ties in signature score
+    are resolved by the smallest QID instead of the order of rows returned by the endpoint.
+    """
+    start_time = time.time()
+    plan = plan_neighbour_lookup(question_entity, conditions)
+    planning_time = time.time()
+    neighbours, execution_steps = execute_neighbour_lookup_plan(plan)
+    end_time = time.time()
+    steps = plan.planning_steps + execution_steps
+
+    logger.info(
+        {
+            "msg": "Question entity neighbours lookup plan",
+            "question_entity": question_entity,
+            "question_entity_degree": plan.question_entity_degree,
+            "question_entity_degree_is_capped": plan.question_entity_degree_is_capped,
+            "merged_conditions": [_condition_to_str(condition) for condition in plan.merged_conditions],
+            "merged_conditions_degrees": plan.merged_conditions_degrees,
+            "member_conditions": [_condition_to_str(condition) for condition in plan.member_conditions],
+            "member_conditions_degrees": plan.member_conditions_degrees,
+            "members_join": plan.members_join if plan.member_conditions else None,
+            # rows probed, planning included
+            "planning_cost": plan.planning_cost,
+            "estimated_cost": plan.estimated_cost,
+            "baseline_cost": plan.baseline_cost,
+            # rows received, planning included
+            "estimated_rows": plan.estimated_rows,
+            "actual_rows": sum(step["rows"] for step in steps),
+            "planning_queries_amount": len(plan.planning_steps),
+            "queries_amount": len(steps),
+            "steps": steps,
+            "planning_time_ms": int((planning_time - start_time) * 1000),
+            "execution_time_ms": int((end_time - planning_time) * 1000),
+        }
+    )
+    return neighbours
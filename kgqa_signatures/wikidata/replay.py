@@ -0,0 +1,293 @@
+"""Replay captured SPARQL queries against an endpoint and report latency, errors and throughput.
+
+Queries are taken either from log.json written by JSONFormatter ('Send request to Wikidata' records)
+or from the joblib cache of execute_sparql_request. With --keep-order the queries of every question
+(run_id and question_index of log records, including ones sent by joblib workers) are replayed
+sequentially, in the logged order, as one session and sessions run concurrently. Records of older
+logs without question_index are grouped by process, the cache gives a single session. --run takes
+queries of a single run from a log appended by several ones.
+
+    python -m kgqa_signatures.wikidata.replay log.json --concurrency 1,2,4,8,16 --rate 50
+"""
+import ast
+import glob
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Union
+
+import requests
+
+from kgqa_signatures.config import CACHE_DIRECTORY, LOG_FILENAME, SPARQL_API_URL
+
+SEND_REQUEST_MSG = "Send request to Wikidata"
+HEADERS = {
+    "Accept": "application/sparql-results+json",
+    "User-Agent": "kgqa_signatures-replay",
+}
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+
+
+@dataclass
+class ReplayResult:
+    concurrency: int
+    duration: float = 0.0
+    # latencies of successful requests, failed ones are kept apart: fast errors of saturated endpoint
+    # must not look like throughput
+    latencies_ms: List[float] = field(default_factory=list)
+    error_latencies_ms: List[float] = field(default_factory=list)
+    errors: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def requests_amount(self) -> int:
+        return len(self.latencies_ms) + len(self.error_latencies_ms)
+
+    @property
+    def errors_amount(self) -> int:
+        return sum(self.errors.values())
+
+    @property
+    def throughput(self) -> float:
+        """Successful requests per second"""
+        return len(self.latencies_ms) / self.duration if self.duration > 0 else 0.0
+
+    @staticmethod
+    def _quantile(latencies_ms: List[float], q: float) -> float:
+        if not latencies_ms:
+            return 0.0
+        latencies = sorted(latencies_ms)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def quantile(self, q: float) -> float:
+        return self._quantile(self.latencies_ms, q)
+
+    def histogram(self) -> "OrderedDict[str, int]":
+        histogram = OrderedDict((f"<={bound}ms", 0) for bound in LATENCY_BUCKETS_MS)
+        histogram[f">{LATENCY_BUCKETS_MS[-1]}ms"] = 0
+        for latency in self.latencies_ms:
+            for bound in LATENCY_BUCKETS_MS:
+                if latency <= bound:
+                    histogram[f"<={bound}ms"] += 1
+                    break
+            else:
+                histogram[f">{LATENCY_BUCKETS_MS[-1]}ms"] += 1
+        return histogram
+
+    def to_dict(self) -> Dict:
+        return {
+            "concurrency": self.concurrency,
+            "requests": self.requests_amount,
+            "errors": self.errors,
+            "error_rate": self.errors_amount / self.requests_amount if self.requests_amount else 0.0,
+            "duration_s": self.duration,
+            "throughput_rps": self.throughput,
+            "latency_ms": {
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                "max": max(self.latencies_ms, default=0.0),
+            },
+            "error_latency_ms": {
+                "p50": self._quantile(self.error_latencies_ms, 0.5),
+                "p99": self._quantile(self.error_latencies_ms, 0.99),
+                "max": max(self.error_latencies_ms, default=0.0),
+            },
+            "histogram": self.histogram(),
+        }
+
+
+def queries_from_log(
+        log_filepath: str = LOG_FILENAME,
+        run_id: Union[str, None] = None,
+) -> "OrderedDict[str, List[str]]":
+    """Sessions of queries (run and question index, or process id for older logs -> queries in logged order)"""
+    sessions = OrderedDict()
+    with open(log_filepath, "r", encoding="utf-8") as log_file:
+        for line in log_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict) or record.get("msg") != SEND_REQUEST_MSG or "request" not in record:
+                continue
+            if run_id is not None and record.get("run_id") != run_id:
+                continue
+            if "question_index" in record:
+                session = f"run-{record.get('run_id')}-question-{record['question_index']}"
+            else:
+                session = f"process-{record.get('process_id')}"
+            sessions.setdefault(session, []).append(record["request"])
+    return sessions
+
+
+def queries_from_cache(cache_directory: str = CACHE_DIRECTORY) -> "OrderedDict[str, List[str]]":
+    """Single session of cached queries ordered by the time they were stored"""
+    pattern = os.path.join(
+        cache_directory, "joblib", "kgqa_signatures", "wikidata", "api", "execute_sparql_request", "*", "metadata.json"
+    )
+    timed_queries = []
+    for metadata_filepath in glob.glob(pattern):
+        try:
+            with open(metadata_filepath, "r", encoding="utf-8") as metadata_file:
+                metadata = json.load(metadata_file)
+            # joblib stores repr of arguments
+            request = ast.literal_eval(metadata["input_args"]["request"])
+        except (ValueError, KeyError, SyntaxError):
+            continue
+        timed_queries.append((metadata.get("time", 0), request))
+    timed_queries.sort(key=lambda x: x[0])
+    return OrderedDict([("cache", [request for _, request in timed_queries])])
+
+
+class _RateLimiter:
+    """Spreads request starts evenly, shared by all worker threads"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start_time = max(self.next_time, now)
+            self.next_time = start_time + self.interval
+        time.sleep(max(0.0, start_time - now))
+
+
+def replay(
+        sessions: "OrderedDict[str, List[str]]",
+        api_url: str = SPARQL_API_URL,
+        concurrency: int = 1,
+        rate: float = 0.0,
+        keep_order: bool = False,
+        timeout: float = 60.0,
+) -> ReplayResult:
+    result = ReplayResult(concurrency)
+    result_lock = threading.Lock()
+    rate_limiter = _RateLimiter(rate)
+    thread_local = threading.local()
+
+    def send(query: str):
+        if not hasattr(thread_local, "session"):
+            thread_local.session = requests.Session()
+        rate_limiter.wait()
+        error = None
+        start_time = time.perf_counter()
+        try:
+            response = thread_local.session.get(
+                api_url,
+                params={"format": "json", "query": query},
+                headers=HEADERS,
+                timeout=timeout,
+            )
+            if response.status_code != 200:
+                error = f"http_{response.status_code}"
+            else:
+                response.json()
+        except requests.exceptions.Timeout:
+            error = "timeout"
+        except requests.exceptions.RequestException as e:
+            error = type(e).__name__
+        except ValueError:
+            error = "invalid_json"
+        latency = (time.perf_counter() - start_time) * 1000
+        with result_lock:
+            if error is None:
+                result.latencies_ms.append(latency)
+            else:
+                result.error_latencies_ms.append(latency)
+                result.errors[error] = result.errors.get(error, 0) + 1
+
+    def send_session(queries: List[str]):
+        for query in queries:
+            send(query)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if keep_order:
+            futures = [executor.submit(send_session, queries) for queries in sessions.values()]
+        else:
+            futures = [executor.submit(send, query) for queries in sessions.values() for query in queries]
+        for future in futures:
+            future.result()
+    result.duration = time.perf_counter() - start_time
+    return result
+
+
+def _print_result(result: ReplayResult):
+    report = result.to_dict()
+    print(
+        f"Concurrency: {report['concurrency']} Requests: {report['requests']}"
+        f" Error rate: {report['error_rate']:.3f} Throughput: {report['throughput_rps']:.1f} rps"
+    )
+    print(
+        f"Latency p50: {report['latency_ms']['p50']:.0f} ms p90: {report['latency_ms']['p90']:.0f} ms"
+        f" p99: {report['latency_ms']['p99']:.0f} ms max: {report['latency_ms']['max']:.0f} ms"
+    )
+    if report["errors"]:
+        print(f"Errors: {report['errors']} latency p50: {report['error_latency_ms']['p50']:.0f} ms"
+              f" p99: {report['error_latency_ms']['p99']:.0f} ms")
+    histogram_max = max(report["histogram"].values(), default=0)
+    for bucket, amount in report["histogram"].items():
+        if amount:
+            print(f"  {bucket:>10} {amount:>8} {'#' * int(40 * amount / histogram_max)}")
+
+
+def main(args):
+    if args.source == "cache":
+        sessions = queries_from_cache(args.path or CACHE_DIRECTORY)
+    else:
+        sessions = queries_from_log(args.path or LOG_FILENAME, run_id=args.run)
+    if args.limit is not None:
+        left = args.limit
+        for key in sessions:
+            sessions[key] = sessions[key][:left]
+            left -= len(sessions[key])
+    print(f"Sessions: {len(sessions)} Queries: {sum(len(queries) for queries in sessions.values())}")
+
+    results = []
+    for concurrency in args.concurrency:
+        result = replay(
+            sessions,
+            api_url=args.endpoint,
+            concurrency=concurrency,
+            rate=args.rate,
+            keep_order=args.keep_order,
+            timeout=args.timeout,
+        )
+        _print_result(result)
+        results.append(result)
+
+    ceiling = max(results, key=lambda x: x.throughput)
+    print(f"Throughput ceiling (successful requests): {ceiling.throughput:.1f} rps"
+          f" at concurrency {ceiling.concurrency}")
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump([result.to_dict() for result in results], output_file, indent=2)
+
+
+if __name__ == "__main__":
+    parse = ArgumentParser(description="Replay captured SPARQL queries against an endpoint")
+    parse.add_argument("path", nargs="?", default=None, help="log.json or cache directory, depends on --source")
+    parse.add_argument("--source", choices=["log", "cache"], default="log", help="Where to take queries from")
+    parse.add_argument("--endpoint", default=SPARQL_API_URL, help="SPARQL endpoint to replay against")
+    parse.add_argument(
+        "--concurrency", default=[1], type=lambda x: [int(item) for item in x.split(",")],
+        help="Comma separated concurrency levels, each one is a separate run (e.g. 1,2,4,8)"
+    )
+    parse.add_argument("--rate", default=0.0, type=float, help="Max requests per second, 0 is unlimited")
+    parse.add_argument("--keep-order", action="store_true", help="Replay queries of every question in logged order")
+    parse.add_argument("--run", default=None, help="Replay only queries of the run with this run_id (log source)")
+    parse.add_argument("--limit", default=None, type=int, help="Replay only first N queries")
+    parse.add_argument("--timeout", default=60.0, type=float, help="Request timeout in seconds")
+    parse.add_argument("--output", default=None, help="Path to write JSON report")
+    main(parse.parse_args())
@@ -1,17 +1,24 @@
 from typing import List, Union, Dict, Iterable
 
+from kgqa_signatures.config import ENTITY_FILTER_ENABLED
 from kgqa_signatures.logger import get_logger
 from kgqa_signatures.wikidata.api import execute_sparql_request
+from kgqa_signatures.wikidata.entity_filter import get_entity_filter, parse_entity
 from kgqa_signatures.wikidata.sparql_condition import SparqlCondition
 
 logger = get_logger()
 
 
+def _typed_object_condition() -> str:
+    return "" if ENTITY_FILTER_ENABLED else "?object wdt:P31 ?smth."
+
+
 def get_entity_one_hop_neighbours(
         entity_id: str,
         direct_only: bool = False,
         conditions: Union[List[SparqlCondition], None] = None,
         match_all_conditions: bool = True,
+        restrict_to: Union[Iterable[str], None] = None,
 ):
     if conditions is None:
         conditions = []
@@ -25,30 +32,39 @@ def get_entity_one_hop_neighbours(
     )
     join_symbol = "\n" if match_all_conditions else " UNION "
     rendered_conditions = join_symbol.join(conditions)
+    if restrict_to is not None:
+        rendered_objects = " ".join(map(lambda x: f"wd:{x}", restrict_to))
+        rendered_conditions = "VALUES ?object { " + rendered_objects + " }\n    " + rendered_conditions
 
     # when entity or property is the root of relation
     # it is depicted here as Qxxx-xxxx-xxx or Pxxx-xxx-xxx instead of Qxxx or Pxxx
     # also we skip all not entity objects by rule '?object wdt:P31 ?smth.'
+    # or, when ENTITY_FILTER_ENABLED, by the client-side entity filter after the request
+    typed_object_condition = _typed_object_condition()
     sparql_query_all = """
 PREFIX wdt: <http://www.wikidata.org/prop/direct/>
 PREFIX wd: <http://www.wikidata.org/entity/>
 SELECT DISTINCT ?property ?object
 WHERE {
     {?object ?property wd:<ENTITY>} UNION {wd:<ENTITY> ?property ?object}.
-    ?object wdt:P31 ?smth.
+    <TYPED_OBJECT_CONDITION>
     <CONDITIONS>
 }
-    """.replace("<ENTITY>", entity_id).replace("<CONDITIONS>", rendered_conditions)
+    """.replace("<ENTITY>", entity_id).replace("<CONDITIONS>", rendered_conditions).replace(
+        "<TYPED_OBJECT_CONDITION>", typed_object_condition
+    )
     sparql_query_direct = """
 PREFIX wdt: <http://www.wikidata.org/prop/direct/>
 PREFIX wd: <http://www.wikidata.org/entity/>
 SELECT DISTINCT ?property ?object
 WHERE {
     wd:<ENTITY> ?property ?object.
-    ?object wdt:P31 ?smth.
+    <TYPED_OBJECT_CONDITION>
     <CONDITIONS>
 }
-    """.replace("<ENTITY>", entity_id).replace("<CONDITIONS>", rendered_conditions)
+    """.replace("<ENTITY>", entity_id).replace("<CONDITIONS>", rendered_conditions).replace(
+        "<TYPED_OBJECT_CONDITION>", typed_object_condition
+    )
     sparql_query = sparql_query_direct if direct_only else sparql_query_all
     result = execute_sparql_request(sparql_query)
 
@@ -61,6 +77,12 @@ WHERE {
         )
         return {}
 
+    if ENTITY_FILTER_ENABLED:
+        typed_objects = get_entity_filter().filter(
+            item["object"]["value"] for item in result if item["object"]["type"] == "uri"
+        )
+        result = [item for item in result if item["object"]["value"] in typed_objects]
+
     parsed_result = []
     for item in result:
         connection_property = item["property"]["value"]
@@ -119,3 +141,87 @@ GROUP BY ?object""".replace("<CONDITIONS>", rendered_conditions).replace("<CANDI
 
     return parsed_result
 
+
+def get_entity_degree(entity_id: str, cap: int) -> int:
+    """Amount of typed neighbours of entity in both directions, counted up to cap"""
+    sparql_query = """
+PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+PREFIX wd: <http://www.wikidata.org/entity/>
+SELECT (COUNT(*) AS ?degree)
+WHERE {
+    SELECT ?object
+    WHERE {
+        {?object ?property wd:<ENTITY>} UNION {wd:<ENTITY> ?property ?object}.
+        <TYPED_OBJECT_CONDITION>
+    }
+    LIMIT <CAP>
+}""".replace("<TYPED_OBJECT_CONDITION>", _typed_object_condition()).replace(
+        "<ENTITY>", entity_id
+    ).replace("<CAP>", str(cap))
+    return _parse_degree(sparql_query, cap)
+
+
+def get_condition_degree(condition: SparqlCondition, cap: int) -> int:
+    """Amount of objects matched by condition, counted up to cap"""
+    rendered_condition = condition.to_sparql_query_condition(source_var="?object", with_end_symbol=False)
+    sparql_query = """
+PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+PREFIX wd: <http://www.wikidata.org/entity/>
+SELECT (COUNT(*) AS ?degree)
+WHERE {
+    SELECT ?object
+    WHERE {
+        <CONDITION>
+    }
+    LIMIT <CAP>
+}""".replace("<CONDITION>", rendered_condition).replace("<CAP>", str(cap))
+    return _parse_degree(sparql_query, cap)
+
+
+def _parse_degree(sparql_query: str, cap: int) -> int:
+    result = execute_sparql_request(sparql_query)
+
+    if not result:
+        logger.error(
+            {
+                "msg": "cached request was with error",
+                "query": sparql_query,
+            }
+        )
+        # unknown degree is treated as the most expensive one
+        return cap
+
+    return int(result[0]["degree"]["value"])
+
+
+def get_condition_members(condition: SparqlCondition) -> List[str]:
+    """Entities (items and properties, as Qxxx/Pxxx) matched by condition"""
+    rendered_condition = condition.to_sparql_query_condition(source_var="?object", with_end_symbol=False)
+    sparql_query = """
+PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+PREFIX wd: <http://www.wikidata.org/entity/>
+SELECT DISTINCT ?object
+WHERE {
+    <CONDITION>
+}""".replace("<CONDITION>", rendered_condition)
+    result = execute_sparql_request(sparql_query)
+
+    if result is None:
+        logger.error(
+            {
+                "msg": "cached request was with error",
+                "query": sparql_query,
+            }
+        )
+        return []
+
+    members = []
+    for item in result:
+        if item["object"]["type"] != "uri":
+            continue
+        # typed properties (wd:Pxxx) are neighbours too, as in the '?object wdt:P31 ?smth' join
+        parsed_entity = parse_entity(item["object"]["value"])
+        if parsed_entity is not None:
+            members.append(f"{parsed_entity[0]}{parsed_entity[1]}")
+
+    return members